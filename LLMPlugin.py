@@ -2,170 +2,586 @@ import sublime
 import sublime_plugin
 import json
 import os
-from threading import Thread
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakSet
 import logging
-import urllib.request
+from logging.handlers import RotatingFileHandler
+import hashlib
+import sqlite3
+import time
+import re
+import itertools
+import functools
+from types import MappingProxyType
+import http.client
+import urllib.parse
 import urllib.error
 import base64
+import gzip
+from contextlib import contextmanager
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    json_loads = json.loads
 
 # Constants
 SETTINGS_FILE = "LLMPlugin.sublime-settings"
 API_KEY_OPENAI = "openai_api_key"
 API_KEY_ANTHROPIC = "anthropic_api_key"
-
-# Set up logging
-logging.basicConfig(filename='llm_plugin.log', level=logging.INFO)
+CACHE_FILE = "LLMPlugin.db"
+LOG_DIR = "LLMPlugin"
+LOG_FILE = "plugin.log"
+LOG_MAX_BYTES = 256_000
+CACHE_TTL = 7 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 500
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 60
+HTTP_POOL_MAXSIZE = 8
+MAX_WORKERS = 4
+GZIP_MIN_SIZE = 1024
+ANTHROPIC_MAX_TOKENS = 1024
+ANTHROPIC_VERSION = "2023-06-01"
+BATCH_SEPARATOR = "\n---\n"
+BATCH_SEPARATOR_PATTERN = re.compile(r"\n\s*---\s*\n")
+DASH_LINE_PATTERN = re.compile(r"^\s*-{3,}\s*$", re.MULTILINE)
+REGION_KEY = "llm_region_{}"
+OPENAI_MODELS = ("gpt-4o-mini", "gpt-4o", "gpt-4")
+ANTHROPIC_MODELS = ("claude-3.5-sonnet", "claude-3-sonnet", "claude-3-opus", "claude-3-haiku")
+PROVIDER_NAMES = ("OpenAI", "Anthropic")
+API_KEY_OPTIONS = ("OpenAI API Key", "Anthropic API Key")
+PROVIDERS = MappingProxyType({
+    "openai": {
+        "api_key": API_KEY_OPENAI,
+        "api_url": "https://api.openai.com/v1/chat/completions",
+        "model_setting": "openai_model",
+        "default_model": "gpt-3.5-turbo",
+        "models": OPENAI_MODELS,
+        "payload": MappingProxyType({}),
+    },
+    "anthropic": {
+        "api_key": API_KEY_ANTHROPIC,
+        "api_url": "https://api.anthropic.com/v1/messages",
+        "model_setting": "anthropic_model",
+        "default_model": "claude-2",
+        "models": ANTHROPIC_MODELS,
+        "payload": MappingProxyType({
+            "model": "claude-3-5-sonnet-20240620",
+            "max_tokens": ANTHROPIC_MAX_TOKENS,
+            "system": "You are an English language expert.",
+        }),
+    },
+})
+PROMPT_TEMPLATES = MappingProxyType({
+    "rewrite_casual": "Rewrite the following text in a casual tone. Use Australian Spelling. Respond only with the updated text.: {text}",
+    "rewrite_professional": "Rewrite the following text in a professional tone. Use Australian Spelling. Respond only with the updated text.: {text}",
+    "summarise": "Summarise the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
+    "expand": "Expand on the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
+    "paraphrase": "Paraphrase the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
+    "correct_grammar": "Correct the grammar in the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
+})
+LOADING_FRAMES = ("⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷")
+
+# Logging is set up in plugin_loaded so importing the plugin doesn't open a file
 logger = logging.getLogger(__name__)
 
-def encrypt(key):
-    return base64.b64encode(key.encode()).decode()
-
-def decrypt(encrypted_key):
-    return base64.b64decode(encrypted_key.encode()).decode()
+def migrate_encoded_keys(settings):
+    # Keys used to be stored base64-encoded, which only obscured them, so decode them once in place
+    if settings.get("api_key_format") == "plain":
+        return
+    for provider in PROVIDERS.values():
+        encoded_key = settings.get(provider["api_key"])
+        if encoded_key:
+            try:
+                settings.set(provider["api_key"], base64.b64decode(encoded_key.encode(), validate=True).decode())
+            except (ValueError, UnicodeDecodeError):
+                logger.warning(f"Leaving {provider['api_key']} as is, it is not base64-encoded")
+    settings.set("api_key_format", "plain")
+
+_SETTINGS = None
+_KEYS = {}
+_HEADERS = {}
+
+def get_settings():
+    global _SETTINGS
+    if _SETTINGS is None:
+        _SETTINGS = sublime.load_settings(SETTINGS_FILE)
+    return _SETTINGS
+
+def reload_keys():
+    settings = get_settings()
+    for name, provider in PROVIDERS.items():
+        api_key = settings.get(provider["api_key"]) or None
+        _KEYS[name] = api_key
+        if api_key is None:
+            _HEADERS.pop(name, None)
+        elif name == "openai":
+            _HEADERS[name] = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        elif name == "anthropic":
+            _HEADERS[name] = {"Content-Type": "application/json", "x-api-key": api_key, "anthropic-version": ANTHROPIC_VERSION}
+
+class LLMCache:
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, ts INTEGER)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(provider, model, action, text):
+        payload = json.dumps({"p": provider, "m": model, "a": action, "t": text}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        now = int(time.time())
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT response, ts FROM responses WHERE key = ?", (key,)).fetchone()
+                # Empty responses are never served, they would wipe the selection
+                if row is None or not row[0]:
+                    return None
+                if now - row[1] > self.ttl:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    return None
+                # Touch the entry so eviction drops the least recently used responses first
+                self._conn.execute("UPDATE responses SET ts = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                return row[0]
+        except sqlite3.Error as e:
+            logger.error(f"Cache lookup failed: {str(e)}")
+            return None
+
+    def set(self, key, value):
+        if not value:
+            return
+        try:
+            with self._lock:
+                self._conn.execute("INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)", (key, value, int(time.time())))
+                self._conn.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY ts DESC LIMIT ?)", (self.max_entries,))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Cache write failed: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_CACHE = None
+_LOG_HANDLER = None
+_EXECUTOR = None
+_INFLIGHT = WeakSet()
+_INDICATOR_ACTIVE = False
+_REGION_IDS = itertools.count()
+
+class ConnectionPool:
+    # Keep-alive fallback for Sublime's plugin host, which doesn't ship urllib3
+    def __init__(self, maxsize=HTTP_POOL_MAXSIZE):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = Lock()
+
+    def acquire(self, host):
+        with self._lock:
+            conns = self._idle.get(host)
+            if conns:
+                return conns.pop(), True
+        # post() switches the socket to HTTP_READ_TIMEOUT once connected
+        return http.client.HTTPSConnection(host, timeout=HTTP_CONNECT_TIMEOUT), False
+
+    def release(self, host, conn):
+        with self._lock:
+            conns = self._idle.setdefault(host, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+_POOL = None
+
+def get_executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="llm")
+    return _EXECUTOR
+
+def get_pool():
+    global _POOL
+    if _POOL is None:
+        if urllib3 is not None:
+            _POOL = urllib3.PoolManager(num_pools=4, maxsize=HTTP_POOL_MAXSIZE, retries=urllib3.Retry(total=2, backoff_factor=0.3))
+        else:
+            _POOL = ConnectionPool()
+    return _POOL
+
+def encode_body(data, headers):
+    body = json_dumps(data)
+    headers = dict(headers)
+    # A gzipped event stream can't be decoded until whole blocks arrive, which would stall streaming
+    if not data.get("stream"):
+        headers["Accept-Encoding"] = "gzip"
+    if len(body) > GZIP_MIN_SIZE and get_settings().get("compress_requests", True):
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+@contextmanager
+def post(url, body, headers):
+    # Errors are raised as urllib.error exceptions whichever backend is in use
+    pool = get_pool()
+    if urllib3 is not None:
+        try:
+            response = pool.request("POST", url, body=body, headers=headers, preload_content=False,
+                                    timeout=urllib3.Timeout(connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT))
+        except urllib3.exceptions.HTTPError as e:
+            raise urllib.error.URLError(e)
+        try:
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            yield response
+        except BaseException as e:
+            # Drop the connection rather than wait for the server to finish a generation nobody will read
+            response.close()
+            response.release_conn()
+            if isinstance(e, urllib3.exceptions.HTTPError):
+                raise urllib.error.URLError(e)
+            raise
+        response.drain_conn()
+        response.release_conn()
+        return
+
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    while True:
+        conn, reused = pool.acquire(parts.netloc)
+        try:
+            if conn.sock is None:
+                conn.connect()
+                conn.sock.settimeout(HTTP_READ_TIMEOUT)
+            conn.request("POST", path, body=body, headers=headers)
+            response = conn.getresponse()
+            break
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+            conn.close()
+            # The server may have dropped an idle connection, so retry on another one
+            if not reused:
+                raise urllib.error.URLError(e)
+        except (OSError, http.client.HTTPException) as e:
+            # Anything else, timeouts included, may have reached the server so don't resend
+            conn.close()
+            raise urllib.error.URLError(e)
+    if response.status >= 400:
+        response.read()
+        conn.close()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+    try:
+        # http.client leaves compressed bodies alone, unlike urllib3
+        if response.getheader("Content-Encoding") == "gzip":
+            yield gzip.GzipFile(fileobj=response)
+        else:
+            yield response
+    except BaseException as e:
+        conn.close()
+        if isinstance(e, (OSError, http.client.HTTPException)) and not isinstance(e, urllib.error.URLError):
+            raise urllib.error.URLError(e)
+        raise
+    if response.isclosed() and not response.will_close:
+        pool.release(parts.netloc, conn)
+    else:
+        conn.close()
 
 class LanguageModelCommand(sublime_plugin.TextCommand):
     def run(self, edit, action, prompt=None):
+        regions = [region for region in self.view.sel() if not region.empty()]
+        if not regions:
+            sublime.status_message("No selection found")
+            return
 
-        settings = sublime.load_settings(SETTINGS_FILE)
+        settings = get_settings()
         selected_provider = settings.get("selected_provider", "openai")
 
-        if selected_provider == "openai":
-            encrypted_api_key = settings.get(API_KEY_OPENAI)
-            api_key = decrypt(encrypted_api_key) if encrypted_api_key else None            
-            api_url = "https://api.openai.com/v1/chat/completions"
-            model = settings.get("openai_model", "gpt-3.5-turbo")
-        elif selected_provider == "anthropic":
-            encrypted_api_key = settings.get(API_KEY_ANTHROPIC)
-            api_key = decrypt(encrypted_api_key) if encrypted_api_key else None            
-            api_url = "https://api.anthropic.com/v1/messages"
-            model = settings.get("anthropic_model", "claude-2")
-        else:
+        provider = PROVIDERS.get(selected_provider)
+        if provider is None:
             sublime.error_message(f"Unknown LLM: {selected_provider}")
             return
+        api_key = _KEYS.get(selected_provider)
+        api_url = provider["api_url"]
+        model = settings.get(provider["model_setting"], provider["default_model"])
 
         if not api_key:
             sublime.error_message(f"API key for {selected_provider} is not set. Please set it in the settings.")
             return
 
-        selection = self.view.sel()
-        if len(selection) > 0:
-            for region in selection:
-                if not region.empty():
-                    text = self.view.substr(region)
-
-                    thread = Thread(target=self.process_text, args=(text, action, api_key, api_url, region, selected_provider, model, prompt))
-                    thread.start()
-                    self.show_loading_indicator(thread)
-                else:
-                    sublime.status_message("No text selected")
+        stream = settings.get("stream", True)
+        texts = [self.view.substr(region) for region in regions]
+        # Track the regions from here on the UI thread, before any queued request can edit the buffer
+        keys = [self.track_region(region) for region in regions]
+        if prompt is None and self.can_batch(texts, selected_provider):
+            self.submit(self.process_batch, texts, action, api_url, keys, selected_provider, model)
         else:
-            sublime.status_message("No selection found")
-
-    def process_text(self, text, action, api_key, api_url, region, selected_provider, model, prompt=None):
+            for key, text in zip(keys, texts):
+                self.submit(self.process_text, text, action, api_url, key, selected_provider, model, prompt, stream)
+
+    def track_region(self, region):
+        key = REGION_KEY.format(next(_REGION_IDS))
+        self.view.add_regions(key, [region], "", "", sublime.HIDDEN)
+        return key
+
+    def submit(self, fn, *args):
+        global _INDICATOR_ACTIVE
+        _INFLIGHT.add(get_executor().submit(fn, *args))
+        if not _INDICATOR_ACTIVE:
+            _INDICATOR_ACTIVE = True
+            sublime.set_timeout(self.show_loading_indicator, 0)
+
+    def can_batch(self, texts, selected_provider):
+        if len(texts) < 2:
+            return False
+        # A dash-only line anywhere in a snippet, even the first or last, could be mistaken for a separator
+        if any(DASH_LINE_PATTERN.search(text) for text in texts):
+            return False
+        # Anthropic responses are capped at max_tokens, so keep large selections as separate requests
+        if selected_provider == "anthropic" and sum(len(text) for text in texts) // 4 > ANTHROPIC_MAX_TOKENS:
+            return False
+        return True
+
+    def process_text(self, text, action, api_url, key, selected_provider, model, prompt=None, stream=False):
         if prompt is None:
             prompt = self.get_prompt(action, text)            
-        
+
+        # Nothing collects the executor's futures, so every failure has to be reported here
+        try:
+            headers, data = self.build_request(prompt, selected_provider, model, stream)
+            cache_key = LLMCache.make_key(selected_provider, data["model"], action, prompt)
+            if _CACHE is not None:
+                cached = _CACHE.get(cache_key)
+                if cached:
+                    sublime.set_timeout(functools.partial(self.apply_results, [key], [cached], False), 0)
+                    return
+
+            if stream:
+                result = self.stream_to_region(api_url, headers, data, selected_provider, key)
+            else:
+                result = self.request_completion(api_url, headers, data, selected_provider)
+                sublime.set_timeout(functools.partial(self.apply_results, [key], [result], False), 0)
+            if _CACHE is not None:
+                _CACHE.set(cache_key, result)
+        except Exception as e:
+            self.report_error(e)
+        finally:
+            sublime.set_timeout(functools.partial(self.view.erase_regions, key), 0)
+
+    def process_batch(self, texts, action, api_url, keys, selected_provider, model):
+        try:
+            prompt = self.get_batch_prompt(action, texts)
+            headers, data = self.build_request(prompt, selected_provider, model)
+            cache_key = LLMCache.make_key(selected_provider, data["model"], action, prompt)
+            result = _CACHE.get(cache_key) if _CACHE is not None else None
+            if result is None:
+                result = self.request_completion(api_url, headers, data, selected_provider)
+            parts = BATCH_SEPARATOR_PATTERN.split(result.strip())
+            if len(parts) != len(texts):
+                logger.warning(f"Batched response had {len(parts)} snippets for {len(texts)} selections, retrying individually")
+                # Collect every reply first and apply them in one edit, so no replacement shifts another's offsets
+                results = [self.complete(self.get_prompt(action, text), action, api_url, selected_provider, model) for text in texts]
+                sublime.set_timeout(functools.partial(self.apply_results, keys, results), 0)
+                return
+            results = [self.keep_outer_whitespace(text, part) for text, part in zip(texts, parts)]
+            sublime.set_timeout(functools.partial(self.apply_results, keys, results), 0)
+            if _CACHE is not None:
+                _CACHE.set(cache_key, result)
+        except Exception as e:
+            self.report_error(e)
+        finally:
+            for key in keys:
+                sublime.set_timeout(functools.partial(self.view.erase_regions, key), 0)
+
+    def complete(self, prompt, action, api_url, selected_provider, model):
+        headers, data = self.build_request(prompt, selected_provider, model)
+        cache_key = LLMCache.make_key(selected_provider, data["model"], action, prompt)
+        result = _CACHE.get(cache_key) if _CACHE is not None else None
+        if not result:
+            result = self.request_completion(api_url, headers, data, selected_provider)
+            if _CACHE is not None:
+                _CACHE.set(cache_key, result)
+        return result
+
+    def keep_outer_whitespace(self, original, replacement):
+        # Splitting a batched reply loses each snippet's surrounding whitespace, so restore the selection's own
+        leading = original[:len(original) - len(original.lstrip())]
+        trailing = original[len(original.rstrip()):]
+        return leading + replacement.strip() + trailing
+
+    def build_request(self, prompt, selected_provider, model, stream=False):
+        data = dict(PROVIDERS[selected_provider]["payload"])
         if selected_provider == "openai":
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-
-            data = {
-                "model": model,
-                "messages": [{"role": "user", "content": prompt}]
-            }
+            data["model"] = model
+            data["messages"] = [{"role": "user", "content": prompt}]
         elif selected_provider == "anthropic":
-            headers = {
-                "Content-Type": "application/json",
-                "x-api-key": f"{api_key}",
-                "max_tokens": 1024
-            }
-
-            data = {                
-                "model": "claude-3-5-sonnet-20240620",
-                "max_tokens" : 1024,
-                "system" : "You are an English language expert.",                
-                "messages": [{"role": "user", "content": [{ "type" : "text", "text" : prompt}]}]
-            }                  
-    
-        try:
-            print(data)
-            req = urllib.request.Request(api_url, data=json.dumps(data).encode('utf-8'), headers=headers, method='POST')            
-            
-            with urllib.request.urlopen(req) as response:
-                response_data = json.loads(response.read().decode('utf-8'))
-                print(response_data)
+            data["messages"] = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
+        if stream:
+            data["stream"] = True
+        headers = _HEADERS.get(selected_provider)
+        if headers is None:
+            # The key can be cleared between run() and the worker picking the request up
+            raise ValueError(f"API key for {selected_provider} is not set. Please set it in the settings.")
+        return headers, data
+
+    def request_completion(self, api_url, headers, data, selected_provider):
+        body, headers = encode_body(data, headers)
+        logger.debug("Request to %s, payload size=%d", api_url, len(body))
+        with post(api_url, body, headers) as response:
+            raw = response.read()
+            logger.debug("Response from %s, payload size=%d", api_url, len(raw))
+            response_data = json_loads(raw)
+            if selected_provider == "openai":
+                return response_data["choices"][0]["message"]["content"]
+            elif selected_provider == "anthropic":
+                return response_data["content"][0]["text"]  
+
+    def stream_completion(self, api_url, headers, data, selected_provider, on_chunk):
+        chunks = []
+        body, headers = encode_body(data, headers)
+        with post(api_url, body, headers) as response:
+            # Read to the end of the body, past [DONE], so the connection can go back to the pool
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    continue
+                event = json_loads(payload)
                 if selected_provider == "openai":
-                    result = response_data["choices"][0]["message"]["content"]
+                    text = event["choices"][0]["delta"].get("content") if event["choices"] else None
                 elif selected_provider == "anthropic":
-                    result = response_data["content"][0]["text"]  
-                sublime.set_timeout(lambda: self.replace_text(region, result), 0)
-                # print(result)
-        except urllib.error.URLError as e:
+                    if event["type"] == "error":
+                        raise RuntimeError(event["error"]["message"])
+                    text = event["delta"].get("text") if event["type"] == "content_block_delta" else None
+                if text:
+                    chunks.append(text)
+                    on_chunk(text, len(chunks) == 1)
+        return "".join(chunks)
+
+    def stream_to_region(self, api_url, headers, data, selected_provider, key):
+        return self.stream_completion(api_url, headers, data, selected_provider,
+                                      lambda text, first: sublime.set_timeout(functools.partial(self.append_text, key, text, first), 0))
+
+    def append_text(self, key, text, replace=False):
+        self.view.run_command("insert_stream", {"key": key, "text": text, "replace": replace})
+
+    def report_error(self, e):
+        if isinstance(e, urllib.error.URLError):
             error_message = f"API request failed: {str(e)}"
-            logger.error(error_message)
-            sublime.error_message(error_message)
-        except KeyError as e:
+        elif isinstance(e, KeyError):
             error_message = f"Unexpected API response format: {str(e)}"
-            logger.error(error_message)
-            sublime.error_message(error_message)
-        except Exception as e:
+        else:
             error_message = f"An unexpected error occurred: {str(e)}"
-            logger.error(error_message)
-            sublime.error_message(error_message)
-
-    def replace_text(self, region, new_text):
-        self.view.run_command("replace_text", {"region": (region.a, region.b), "text": new_text})
+        logger.error(error_message)
+        sublime.error_message(error_message)
+
+    def apply_results(self, keys, texts, select=True):
+        # Look the regions up when applying, other requests may have moved the text since run()
+        edits = []
+        for key, text in zip(keys, texts):
+            regions = self.view.get_regions(key)
+            if regions:
+                edits.append((regions[0].a, regions[0].b, text))
+        if edits:
+            self.view.run_command("replace_text_batch", {"edits": edits, "select": select})
+
+    def get_batch_prompt(self, action, texts):
+        instruction = (f"The text below contains {len(texts)} separate snippets, separated by lines containing only '---'. "
+                       f"Apply the following instruction to each snippet independently and return exactly {len(texts)} snippets "
+                       "in the same order, separated by lines containing only '---'.")
+        return f"{instruction}\n\n{self.get_prompt(action, BATCH_SEPARATOR.join(texts))}"
 
     def get_prompt(self, action, text):
-        prompts = {
-            "rewrite_casual": f"Rewrite the following text in a casual tone. Use Australian Spelling. Respond only with the updated text.: {text}",
-            "rewrite_professional": f"Rewrite the following text in a professional tone. Use Australian Spelling. Respond only with the updated text.: {text}",
-            "summarise": f"Summarise the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
-            "expand": f"Expand on the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
-            "paraphrase": f"Paraphrase the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
-            "correct_grammar": f"Correct the grammar in the following text. Use Australian Spelling. Respond only with the updated text.: {text}",
-            "dynamic_prompt": text
-        }
-        return prompts.get(action, f"Process the following text. : {text}")
-
-    def show_loading_indicator(self, thread):
-        i = 0
-        frames = ["⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷"]
-        while thread.is_alive():
-            sublime.status_message(f"Processing {frames[i % len(frames)]}")
-            sublime.set_timeout(lambda: None, 100)
-            i += 1
-        sublime.status_message("Processing complete")
+        template = PROMPT_TEMPLATES.get(action)
+        if template is not None:
+            return template.format(text=text)
+        return text if action == "dynamic_prompt" else f"Process the following text. : {text}"
+
+    def show_loading_indicator(self, i=0):
+        global _INDICATOR_ACTIVE
+        if any(not future.done() for future in list(_INFLIGHT)):
+            sublime.status_message(f"Processing {LOADING_FRAMES[i % len(LOADING_FRAMES)]}")
+            sublime.set_timeout(functools.partial(self.show_loading_indicator, i + 1), 100)
+        else:
+            _INDICATOR_ACTIVE = False
+            sublime.status_message("Processing complete")
 
 class ReplaceTextCommand(sublime_plugin.TextCommand):
     def run(self, edit, region, text):
         self.view.replace(edit, sublime.Region(region[0], region[1]), text)
 
-class RewriteCasualCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
-        self.view.run_command("language_model", {"action": "rewrite_casual"})
-
-class RewriteProfessionalCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
-        self.view.run_command("language_model", {"action": "rewrite_professional"})
-
-class SummariseCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
-        self.view.run_command("language_model", {"action": "summarise"})
-
-class ExpandCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
-        self.view.run_command("language_model", {"action": "expand"})
-
-class ParaphraseCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
-        self.view.run_command("language_model", {"action": "paraphrase"})
+class InsertStreamCommand(sublime_plugin.TextCommand):
+    def run(self, edit, key, text, replace=False):
+        regions = self.view.get_regions(key)
+        if not regions:
+            return
+        region = regions[0]
+        # The first chunk replaces the selection, later chunks are appended after the text streamed so far
+        if replace:
+            self.view.replace(edit, region, text)
+            region = sublime.Region(region.begin(), region.begin() + len(text))
+        else:
+            self.view.insert(edit, region.end(), text)
+            region = sublime.Region(region.begin(), region.end() + len(text))
+        self.view.add_regions(key, [region], "", "", sublime.HIDDEN)
+
+class ReplaceTextBatchCommand(sublime_plugin.TextCommand):
+    def run(self, edit, edits, select=True):
+        edits = sorted((min(a, b), max(a, b), text) for a, b, text in edits)
+        # Replace from the end of the buffer backwards so earlier offsets stay valid
+        for a, b, text in reversed(edits):
+            self.view.replace(edit, sublime.Region(a, b), text)
+        if not select:
+            return
 
-class CorrectGrammarCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
-        self.view.run_command("language_model", {"action": "correct_grammar"})
+        # Select the new text, shifting each region by the size change of the edits before it
+        selection = self.view.sel()
+        selection.clear()
+        shift = 0
+        for a, b, text in edits:
+            selection.add(sublime.Region(a + shift, a + shift + len(text)))
+            shift += len(text) - (b - a)
+
+def action_command(action):
+    # rewrite_casual -> RewriteCasualCommand, which Sublime registers as "rewrite_casual"
+    name = action.title().replace("_", "") + "Command"
+    return type(name, (sublime_plugin.TextCommand,), {
+        "run": lambda self, edit: self.view.run_command("language_model", {"action": action})
+    })
+
+for _action in PROMPT_TEMPLATES:
+    _command = action_command(_action)
+    globals()[_command.__name__] = _command
+del _action, _command
 
 class DynamicPromptResponseCommand(sublime_plugin.TextCommand):
     def run(self, edit):
@@ -176,22 +592,19 @@ class DynamicPromptResponseCommand(sublime_plugin.TextCommand):
 
 class SetApiKeyCommand(sublime_plugin.ApplicationCommand):
     def run(self):
-        settings = sublime.load_settings(SETTINGS_FILE)
-        options = ["OpenAI API Key", "Anthropic API Key"]
-        
         def on_done(index):
             if index != -1:
                 key_type = API_KEY_OPENAI if index == 0 else API_KEY_ANTHROPIC
                 self.prompt_for_api_key(key_type)
         
-        sublime.active_window().show_quick_panel(options, on_done)
+        sublime.active_window().show_quick_panel(list(API_KEY_OPTIONS), on_done)
 
     def prompt_for_api_key(self, key_type):
+        settings = get_settings()
+
         def on_done(api_key):
             if api_key:
-                encrypted_key = encrypt(api_key)
-                settings = sublime.load_settings(SETTINGS_FILE)
-                settings.set(key_type, encrypted_key)
+                settings.set(key_type, api_key)
                 sublime.save_settings(SETTINGS_FILE)
                 sublime.status_message(f"{key_type} updated successfully")
             else:
@@ -201,50 +614,95 @@ class SetApiKeyCommand(sublime_plugin.ApplicationCommand):
 
 class SelectModelCommand(sublime_plugin.ApplicationCommand):
     def run(self):
-        settings = sublime.load_settings(SETTINGS_FILE)
+        settings = get_settings()
         selected_provider = settings.get("selected_provider", "openai")
         
-        if selected_provider == "openai":
-            options = ["gpt-4o-mini", "gpt-4o", "gpt-4"]
-            setting_key = "openai_model"
-        elif selected_provider == "anthropic":
-            options = ["claude-3.5-sonnet", "claude-3-sonnet", "claude-3-opus", "claude-3-haiku"]
-            setting_key = "anthropic_model"
-        else:
+        provider = PROVIDERS.get(selected_provider)
+        if provider is None:
             sublime.error_message(f"Unknown LLM: {selected_provider}")
             return
+        models = provider["models"]
+        setting_key = provider["model_setting"]
 
         def on_done(index):
             if index != -1:
-                settings.set(setting_key, options[index])
+                settings.set(setting_key, models[index])
                 sublime.save_settings(SETTINGS_FILE)
-                sublime.status_message(f"Selected model: {options[index]}")
+                sublime.status_message(f"Selected model: {models[index]}")
         
-        sublime.active_window().show_quick_panel(options, on_done)
+        sublime.active_window().show_quick_panel(list(models), on_done)
 
 class SwitchProviderCommand(sublime_plugin.ApplicationCommand):
     def run(self):
-        settings = sublime.load_settings(SETTINGS_FILE)
-        options = ["OpenAI", "Anthropic"]
+        settings = get_settings()
         
         def on_done(index):
             if index != -1:
-                new_llm = options[index].lower()
+                new_llm = PROVIDER_NAMES[index].lower()
                 settings.set("selected_provider", new_llm)
                 sublime.save_settings(SETTINGS_FILE)
-                sublime.status_message(f"Switched to {options[index]} LLM")
+                sublime.status_message(f"Switched to {PROVIDER_NAMES[index]} LLM")
         
-        sublime.active_window().show_quick_panel(options, on_done)
+        sublime.active_window().show_quick_panel(list(PROVIDER_NAMES), on_done)
+
+class ClearLlmCacheCommand(sublime_plugin.ApplicationCommand):
+    def run(self):
+        if _CACHE is None:
+            sublime.status_message("Response cache is disabled")
+            return
+        _CACHE.clear()
+        sublime.status_message("Response cache cleared")
+
+def setup_logging():
+    global _LOG_HANDLER
+    log_dir = os.path.join(sublime.cache_path(), LOG_DIR)
+    os.makedirs(log_dir, exist_ok=True)
+    _LOG_HANDLER = RotatingFileHandler(os.path.join(log_dir, LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=2, delay=True)
+    _LOG_HANDLER.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(_LOG_HANDLER)
+    logger.setLevel(logging.INFO)
 
 def plugin_loaded():
-    settings = sublime.load_settings(SETTINGS_FILE)
+    global _CACHE
+    setup_logging()
+    settings = get_settings()
     if not settings.has("selected_provider"):
         settings.set("selected_provider", "openai")
-    if not settings.has("openai_model"):
-        settings.set("openai_model", "gpt-3.5-turbo")
-    if not settings.has("anthropic_model"):
-        settings.set("anthropic_model", "claude-2")
+    for provider in PROVIDERS.values():
+        if not settings.has(provider["model_setting"]):
+            settings.set(provider["model_setting"], provider["default_model"])
+    migrate_encoded_keys(settings)
     sublime.save_settings(SETTINGS_FILE)
 
+    reload_keys()
+    settings.add_on_change("llm_keys", reload_keys)
+
+    if settings.get("cache_enabled", True):
+        cache_path = os.path.join(sublime.cache_path(), CACHE_FILE)
+        _CACHE = LLMCache(cache_path, ttl=settings.get("cache_ttl", CACHE_TTL))
+
+    get_pool()
+
 def plugin_unloaded():
-    pass
+    global _CACHE, _POOL, _SETTINGS, _EXECUTOR, _LOG_HANDLER
+    if _EXECUTOR is not None:
+        # cancel_futures needs Python 3.9, so cancel queued work by hand
+        for future in list(_INFLIGHT):
+            future.cancel()
+        _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = None
+    if _SETTINGS is not None:
+        _SETTINGS.clear_on_change("llm_keys")
+        _SETTINGS = None
+    _KEYS.clear()
+    _HEADERS.clear()
+    if _POOL is not None:
+        _POOL.clear()
+        _POOL = None
+    if _CACHE is not None:
+        _CACHE.close()
+        _CACHE = None
+    if _LOG_HANDLER is not None:
+        logger.removeHandler(_LOG_HANDLER)
+        _LOG_HANDLER.close()
+        _LOG_HANDLER = None